@@ -0,0 +1,55 @@
+# Copyright (c) Karan Desai (https://kdexd.xyz), The University of Michigan.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+r"""
+Simple module to read and write (potentially very large) JSON files, such as
+RedCaps annotations, and to list images present on disk. JSON files are handled
+by ``orjson``, which is several times faster than the standard library ``json``
+module and uses less memory.
+"""
+
+import os
+from typing import Any, Dict, Iterable, Set
+
+import orjson
+
+
+def load_json(path: str) -> Any:
+    r"""Read a JSON file and return the parsed Python object."""
+    with open(path, "rb") as f:
+        return orjson.loads(f.read())
+
+
+def dump_json(obj: Any, path: str):
+    r"""Write a Python object (made of native types) to a JSON file."""
+    with open(path, "wb") as f:
+        f.write(orjson.dumps(obj))
+
+
+def list_images(images_dirpath: str, subreddits: Iterable[str]) -> Dict[str, Set[str]]:
+    r"""
+    List file names of images present in subreddit sub-directories of a RedCaps
+    image directory. This reads every sub-directory once, which is much faster
+    than checking whether each image path exists (one syscall per image).
+
+    Args:
+        images_dirpath: Path to RedCaps image directory.
+        subreddits: Names of subreddits (sub-directories) to list images from.
+
+    Returns:
+        A dict with subreddit names as keys, and sets of image file names (e.g.
+        ``{"4qdg3x.jpg", ...}``) as values. Missing sub-directories have empty sets.
+    """
+    images: Dict[str, Set[str]] = {}
+    for subreddit in subreddits:
+        dirpath = os.path.join(images_dirpath, subreddit)
+
+        if os.path.isdir(dirpath):
+            with os.scandir(dirpath) as entries:
+                images[subreddit] = {entry.name for entry in entries}
+        else:
+            images[subreddit] = set()
+
+    return images
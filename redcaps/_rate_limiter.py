@@ -0,0 +1,37 @@
+# Copyright (c) Karan Desai (https://kdexd.xyz), The University of Michigan.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+r"""Simple module to space out API requests made from multiple threads."""
+
+import threading
+import time
+
+
+class RateLimiter(object):
+    r"""
+    Thread-safe rate limiter that allows at most one call per ``interval``
+    seconds, shared across all threads. Calling :meth:`wait` blocks the calling
+    thread till its turn comes up, other threads are not blocked meanwhile.
+
+    Args:
+        interval: Minimum time (in seconds) between two consecutive calls.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next_time = 0.0
+
+    def wait(self):
+        r"""Block till the next call is allowed as per rate limit."""
+
+        # Reserve a time slot for this call, then sleep outside the lock.
+        with self._lock:
+            now = time.monotonic()
+            wait_time = self._next_time - now
+            self._next_time = max(now, self._next_time) + self.interval
+
+        if wait_time > 0:
+            time.sleep(wait_time)
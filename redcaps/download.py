@@ -3,19 +3,18 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-import json
-import multiprocessing as mp
 import os
-import time
 from calendar import Calendar
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Set
 
 import click
 from tqdm import tqdm
 
 import redcaps
 import redcaps._color_print as cprint
+from redcaps._io import dump_json, list_images, load_json
 from redcaps.downloaders import (
     ImageDownloader,
     RedditIdDownloader,
@@ -61,7 +60,7 @@ def download_anns(
     """
 
     # Load Reddit and Imgur API credentials.
-    credentials = json.load(open(credentials))
+    credentials = load_json(credentials)
     cprint.white(f"Downloading posts from {subreddit}, {yyyy_mm.strftime('%Y-%m')}")
 
     # Iterate over all days of the month. Calendar module returns extra dates
@@ -73,13 +72,19 @@ def download_anns(
         if _date.month == yyyy_mm.month
     ]
     # Download IDs of Reddit posts for all dates (uses Pushshift API internally).
-    REDDIT_POST_IDS: List[str] = []
-    for _date in dates_per_month:
-        id_downloader = RedditIdDownloader(subreddit, _date)
-        REDDIT_POST_IDS.extend(id_downloader.download(time_window))
-
-    # De-duplicate and sort IDs.
-    REDDIT_POST_IDS = sorted(set(REDDIT_POST_IDS))
+    # Dates are independent, so download them in parallel threads. Pushshift
+    # requests from all threads are rate-limited together. Collect IDs in a set
+    # to de-duplicate them, just in case a post was retrieved twice.
+    UNIQUE_POST_IDS: Set[str] = set()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for _ids in executor.map(
+            lambda _date: RedditIdDownloader(subreddit, _date).download(time_window),
+            dates_per_month,
+        ):
+            UNIQUE_POST_IDS.update(_ids)
+
+    # Sort IDs.
+    REDDIT_POST_IDS: List[str] = sorted(UNIQUE_POST_IDS)
 
     # Download post info for all the downloaded post IDs.
     info_downloader = RedditInfoDownloader(credentials=credentials)
@@ -105,7 +110,7 @@ def download_anns(
         output = os.path.join(save_to, f"{subreddit}_{monthstr}.json")
 
     os.makedirs(os.path.dirname(output) or os.curdir, exist_ok=True)
-    json.dump(ANNOTATIONS_TO_SAVE, open(output, "w"))
+    dump_json(ANNOTATIONS_TO_SAVE, output)
     cprint.green(f"[{monthstr}] Saved annotations at {output}.\n")
 
 
@@ -131,8 +136,9 @@ def download_anns(
     which the images failed to download.""",
 )
 @click.option(
-    "-j", "--workers", type=int, default=4,
-    help="Number of workers to download images in parallel.",
+    "-j", "--workers", type=int, default=32,
+    help="""Number of threads to download images in parallel. Requests to each
+    image host are rate-limited irrespective of this number.""",
 )
 def download_imgs(
     annotations_filepath: str,
@@ -142,58 +148,60 @@ def download_imgs(
     workers: int,
 ):
     # Load annotations to download images. Image URL available as "url".
-    ANNOTATIONS: Dict[str, Any] = json.load(open(annotations_filepath))
+    ANNOTATIONS: Dict[str, Any] = load_json(annotations_filepath)
     image_downloader = ImageDownloader(longer_resize=resize)
 
-    # Parallelize image downloads.
-    with mp.Pool(processes=workers) as p:
-
-        worker_args: List[Tuple] = []
-        for ann in ANNOTATIONS["annotations"]:
-            image_savepath = os.path.join(
-                save_to, ann["subreddit"], f"{ann['image_id']}.jpg"
+    # List images that already exist (per subreddit), to skip downloading them.
+    # Create all subreddit directories beforehand, so download threads need not.
+    subreddits: Set[str] = {ann["subreddit"] for ann in ANNOTATIONS["annotations"]}
+    existing_images = list_images(save_to, subreddits)
+
+    for subreddit in subreddits:
+        os.makedirs(os.path.join(save_to, subreddit), exist_ok=True)
+    # Keep track of image IDs to download, in same order as URLs and save paths.
+    image_ids: List[str] = []
+    image_urls: List[str] = []
+    image_savepaths: List[str] = []
+
+    for ann in ANNOTATIONS["annotations"]:
+        image_filename = f"{ann['image_id']}.jpg"
+        if image_filename not in existing_images[ann["subreddit"]]:
+            image_ids.append(ann["image_id"])
+            image_urls.append(ann["url"])
+            image_savepaths.append(
+                os.path.join(save_to, ann["subreddit"], image_filename)
             )
-            if not os.path.exists(image_savepath):
-                worker_args.append((ann["url"], image_savepath, image_downloader))
 
-        # Collect download status of images in these annotations (True/False).
-        download_status: List[bool] = []
+    # Collect download status of images in these annotations (True/False).
+    # Downloads are I/O bound, so the downloader uses threads that share it (no
+    # need to copy it to worker processes).
+    download_status: List[bool] = []
 
-        with tqdm(total=len(worker_args), desc="Downloading Images") as pbar:
-            for _status in p.imap(_image_worker, worker_args):
-                download_status.append(_status)
-                pbar.update()
+    with tqdm(total=len(image_urls), desc="Downloading Images") as pbar:
+        for _status in image_downloader.download_many(
+            image_urls, image_savepaths, max_workers=workers
+        ):
+            download_status.append(_status)
+            pbar.update()
 
     # How many images were downloaded?
     num_downloaded = sum(download_status)
     cprint.green(
-        f"Downloaded {num_downloaded}/{len(worker_args)} images "
+        f"Downloaded {num_downloaded}/{len(image_urls)} images "
         f"from {annotations_filepath}!"
     )
-    # Optionally remove annotations for which images were unavailable.
+    # Optionally remove annotations for which images were unavailable. Images
+    # that existed before are not downloaded again, so keep their annotations.
     if update_annotations:
+        failed_ids: Set[str] = {
+            _id for _id, downloaded in zip(image_ids, download_status) if not downloaded
+        }
         ANNOTATIONS["annotations"] = [
             ann
-            for ann, downloaded in zip(ANNOTATIONS["annotations"], download_status)
-            if downloaded
+            for ann in ANNOTATIONS["annotations"]
+            if ann["image_id"] not in failed_ids
         ]
 
         cprint.white(f"Saving updated annotations...")
-        json.dump(ANNOTATIONS, open(annotations_filepath, "w"))
+        dump_json(ANNOTATIONS, annotations_filepath)
         cprint.green(f"Saved updated annotations at {annotations_filepath}!")
-
-
-def _image_worker(args):
-    r"""Helper method for parallelizing image downloads."""
-    image_url, image_savepath, image_downloader = args
-
-    download_status = image_downloader.download(image_url, save_to=image_savepath)
-
-    # Sleep for 2 seconds for Imgur, and 0.1 seconds for Reddit and Flickr.
-    # This takes care of all request rate limits.
-    if "imgur" in image_url:
-        time.sleep(2.0)
-    else:
-        time.sleep(0.1)
-
-    return download_status
@@ -5,18 +5,26 @@
 
 import datetime
 import json
-import time
 from typing import Dict, List, Union
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 import redcaps._color_print as cprint
+from redcaps._rate_limiter import RateLimiter
+
+# Pushshift API rate limit is shared by all downloaders (possibly running in
+# multiple threads): make at most one request per second.
+PUSHSHIFT_RATE_LIMITER = RateLimiter(1.0)
 
 
 class RedditIdDownloader(object):
     r"""
     Download IDs of image posts made to a particular subreddit on a single date.
     This downloader internally uses the `Pushshift API <pushshift.io>`_.
+    Multiple downloaders (e.g. for different dates) can run in parallel threads,
+    their requests are rate-limited together.
 
     Args:
         subreddit: Name of subreddit to download Reddit post IDs.
@@ -44,6 +52,18 @@ class RedditIdDownloader(object):
         self._allow_domains.extend([f"farm{i}.static.flickr.com" for i in range(9)])
         self._allow_domains.extend([f"farm{i}.staticflickr.com" for i in range(9)])
 
+        # Keep-alive session to reuse a connection for all Pushshift requests.
+        # Failed requests (rate limited or server errors) are retried with an
+        # exponential backoff.
+        retry = Retry(
+            total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504]
+        )
+        self._session = requests.Session()
+        self._session.mount(
+            "https://",
+            HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry),
+        )
+
     def download(self, time_window: float = 24.0) -> List[str]:
         r"""
         Download the list of Reddit post IDs from a single subreddit made on a
@@ -57,6 +77,7 @@ class RedditIdDownloader(object):
 
         Returns:
             Submission IDs, base36 strings (e.g. ``["4qdg3x", "a2b4e6", ...]``).
+            These may contain duplicates, in case a post was retrieved twice.
         """
 
         # Gather Reddit post IDs in this list.
@@ -70,12 +91,10 @@ class RedditIdDownloader(object):
         while start < end:
             REDDIT_IDS.extend(self._download_worker(start, time_window))
 
-            # Advance the time window and sleep to stay within API rate limit.
+            # Advance the time window.
             start += datetime.timedelta(hours=time_window)
-            time.sleep(1)
 
-        # De-duplicate IDs, just in case a post was retrieved twice.
-        return list(set(REDDIT_IDS))
+        return REDDIT_IDS
 
     def _download_worker(
         self, start_time: datetime, time_window: float = 24.0
@@ -85,7 +104,7 @@ class RedditIdDownloader(object):
         ``start_time + time_window``. This method is used internally by
         :meth:`download`, and it handles two edge cases:
 
-            1. If the Pushshift request fails, it attempts a retry.
+            1. If the Pushshift request fails, it retries with exponential backoff.
             2. Pushshift can return 100 IDs per request. If 100 IDs are received,
                then it retries smaller time windows recursively.
         """
@@ -111,15 +130,16 @@ class RedditIdDownloader(object):
                 + ",".join([f"farm{i}.staticflickr.com" for i in range(9)])
             ),
         }
-        # GET request to download metadata for Reddit posts in this time window.
-        # Keep retrying till we get OK response (200).
-        status_code = 404
-        while status_code != 200:
-            response = requests.get(
-                "https://api.pushshift.io/reddit/submission/search", params=payload
-            )
-            status_code = response.status_code
-            time.sleep(1)
+        # GET request to download metadata for Reddit posts in this time window,
+        # after waiting for our turn to stay within API rate limit. Session
+        # retries failed requests, raise an error if all retries fail.
+        PUSHSHIFT_RATE_LIMITER.wait()
+        response = self._session.get(
+            "https://api.pushshift.io/reddit/submission/search",
+            params=payload,
+            timeout=30,
+        )
+        response.raise_for_status()
 
         response = json.loads(response.content)["data"]
         _ids = [r["id"] for r in response]
@@ -5,9 +5,34 @@
 
 import io
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Set, Tuple
 
+import PIL
 import requests
-from PIL import Image
+from PIL import Image, features
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import redcaps._color_print as cprint
+from redcaps._rate_limiter import RateLimiter
+
+# Minimum time interval (in seconds) between two requests made to an image host,
+# shared across all download threads. This takes care of all request rate limits.
+IMAGE_HOST_RATE_LIMITERS: Dict[str, RateLimiter] = {
+    "imgur": RateLimiter(0.5),
+    "flickr": RateLimiter(0.025),
+    "reddit": RateLimiter(0.025),
+}
+
+# Images larger than this (in bytes) are not downloaded. RedCaps images are
+# usually just a few MB, much larger files are unlikely to be valid photos.
+MAX_IMAGE_BYTES: int = 25 * 1024 * 1024
+
+# Timeout (in seconds) to connect to an image host, and to wait for it to send
+# data. Dead hosts do not block download threads for long.
+REQUEST_TIMEOUT: Tuple[float, float] = (3.05, 10)
 
 
 class ImageDownloader(object):
@@ -17,15 +42,53 @@ class ImageDownloader(object):
     which are sourced from Reddit (``i.redd.it``), Imgur (``i.imgur.com``) or
     Flickr (``farm.static.flickr.com``).
 
+    This downloader can be shared by multiple threads. It keeps a pool of open
+    connections per image host, so consecutive downloads from the same host do
+    not need a new TCP connection and TLS handshake.
+
     Args:
         longer_resize: Resize the longer edge of image to this size before
-            saving to disk (preserve aspect ratio). Set to -1 to avoid any
-            resizing. Defaults to 512.
+            saving to disk (preserve aspect ratio). Smaller images are not
+            resized. Set to -1 to avoid any resizing. Defaults to 512.
+        max_connections_per_host: Maximum number of concurrent connections to
+            a single image host. Threads wait for a free connection beyond this.
     """
 
-    def __init__(self, longer_resize: int = 512):
+    # Whether Pillow has been checked for a fast JPEG decoder (done only once).
+    _checked_pillow_build = False
+
+    def __init__(self, longer_resize: int = 512, max_connections_per_host: int = 16):
         self.longer_resize = longer_resize
 
+        # JPEG decoding is several times slower without libjpeg-turbo. Pillow
+        # wheels include it, but source builds (like Pillow-SIMD) may not.
+        if not ImageDownloader._checked_pillow_build:
+            ImageDownloader._checked_pillow_build = True
+            if not features.check_feature("libjpeg_turbo"):
+                cprint.yellow(
+                    f"Pillow {PIL.__version__} is not built with libjpeg-turbo, "
+                    "image decoding will be slow."
+                )
+
+        # Keep-alive session shared by all threads, with a blocking connection
+        # pool per host (limits concurrency per host). Retry a couple of times
+        # (with backoff) for transient errors, like too many requests.
+        self._session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=max_connections_per_host,
+            pool_block=True,
+            max_retries=Retry(
+                total=2, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504]
+            ),
+        )
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+        # Directories that are known to exist, images are saved in a handful of
+        # directories (one per subreddit) so we need not create them every time.
+        self._existing_dirs: Set[str] = set()
+
     def download(self, url: str, save_to: str) -> bool:
         r"""
         Download image from ``url`` and save it to ``save_to``.
@@ -40,35 +103,117 @@ class ImageDownloader(object):
         """
 
         try:
-            # 'response.content' will have our image (as bytes) if successful.
-            response = requests.get(url)
-
-            # Check if image was downloaded (response must be 200). One exception:
-            # Imgur gives response 200 with "removed.png" image if not found.
-            if response.status_code != 200 or "removed.png" in response.url:
-                return False
+            # Stream the response, image bytes are only read after checking the
+            # response headers (and the connection is released after reading).
+            with self._session.get(
+                url, stream=True, timeout=REQUEST_TIMEOUT
+            ) as response:
+
+                # Check if image was downloaded (response must be 200). Exception:
+                # Imgur gives response 200 with "removed.png" image if not found.
+                if response.status_code != 200 or "removed.png" in response.url:
+                    return False
+
+                # Reject very large images early if their size is known, else
+                # stop reading once the size limit is crossed.
+                if int(response.headers.get("Content-Length", 0)) > MAX_IMAGE_BYTES:
+                    return False
+
+                image_bytes = response.raw.read(
+                    MAX_IMAGE_BYTES + 1, decode_content=True
+                )
+                if len(image_bytes) > MAX_IMAGE_BYTES:
+                    return False
+
+            # Write image to disk if it was downloaded successfully. PIL needs a
+            # seekable file, so a raw (socket) stream is not passed directly.
+            pil_image = Image.open(io.BytesIO(image_bytes))
+
+            # Let JPEG decoder shrink the image while decoding it (by 1/2, 1/4 or
+            # 1/8) if it is much bigger than needed. Keep it at least twice the
+            # resize target, so later resizing does not lose quality. This does
+            # nothing for other image formats.
+            if self.longer_resize > 0:
+                pil_image.draft("RGB", (self.longer_resize * 2, self.longer_resize * 2))
 
-            # Write image to disk if it was downloaded successfully.
-            pil_image = Image.open(io.BytesIO(response.content)).convert("RGB")
+            # Palette and bilevel images can only be resized with nearest neighbor
+            # interpolation, convert them before resizing.
+            if pil_image.mode in {"1", "P"}:
+                pil_image = pil_image.convert("RGB")
 
             # Resize image to longest max size while preserving aspect ratio if
-            # longest max size is provided (not -1), and image is bigger.
+            # longest max size is provided (not -1), and image is bigger. Image
+            # is first reduced with a fast box filter (to at least thrice the
+            # target size), and then resized. This is done in-place.
             if self.longer_resize > 0:
-                image_width, image_height = pil_image.size
-
-                scale = self.longer_resize / float(max(image_width, image_height))
+                pil_image.thumbnail(
+                    (self.longer_resize, self.longer_resize),
+                    Image.BILINEAR,
+                    reducing_gap=3.0,
+                )
 
-                if scale != 1.0:
-                    new_width, new_height = tuple(
-                        int(round(d * scale)) for d in (image_width, image_height)
-                    )
-                    pil_image = pil_image.resize((new_width, new_height))
+            if pil_image.mode != "RGB":
+                pil_image = pil_image.convert("RGB")
 
             # Save the downloaded image to disk.
-            os.makedirs(os.path.dirname(save_to), exist_ok=True)
+            save_dir = os.path.dirname(save_to)
+            if save_dir not in self._existing_dirs:
+                os.makedirs(save_dir, exist_ok=True)
+                self._existing_dirs.add(save_dir)
+
             pil_image.save(save_to)
 
             return True
 
         except Exception:
             return False
+
+    def download_many(
+        self, urls: List[str], save_paths: List[str], max_workers: int = 32
+    ) -> Iterator[bool]:
+        r"""
+        Download images from many URLs concurrently, using a pool of threads
+        that share this downloader. Requests to each image host are rate-limited
+        irrespective of the number of threads.
+
+        Args:
+            urls: List of image URLs to download from.
+            save_paths: List of local paths to save the downloaded images, same
+                length as ``urls``.
+            max_workers: Number of threads to download images in parallel.
+
+        Returns:
+            An iterator of boolean variables indicating whether each download
+            was successful, in the same order as ``urls``. Downloads are done
+            in background while this iterator is consumed.
+        """
+        # Keep only a few downloads per thread pending at any time, instead of
+        # submitting all URLs at once (and holding all their futures).
+        num_pending = 4 * max_workers
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = deque()
+
+            for url, save_to in zip(urls, save_paths):
+                futures.append(
+                    executor.submit(self._rate_limited_download, url, save_to)
+                )
+
+                if len(futures) >= num_pending:
+                    yield futures.popleft().result()
+
+            while len(futures) > 0:
+                yield futures.popleft().result()
+
+    def _rate_limited_download(self, url: str, save_to: str) -> bool:
+        r"""Wait for our turn to make a request to this image host, and download."""
+
+        # Only the threads downloading from the same host wait for each other.
+        if "imgur" in url:
+            IMAGE_HOST_RATE_LIMITERS["imgur"].wait()
+        elif "flickr" in url:
+            IMAGE_HOST_RATE_LIMITERS["flickr"].wait()
+        else:
+            IMAGE_HOST_RATE_LIMITERS["reddit"].wait()
+
+        return self.download(url, save_to)
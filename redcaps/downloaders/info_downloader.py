@@ -6,15 +6,40 @@
 import json
 import re
 import sys
+import threading
 import time
-from typing import Any, Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Dict, Iterator, List
 
 import ftfy
 import praw
 import requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 
 import redcaps._color_print as cprint
+from redcaps._rate_limiter import RateLimiter
+
+# Reddit API allows 60 requests per minute per OAuth client, shared by all
+# download threads.
+REDDIT_API_RATE_LIMITER = RateLimiter(1.0)
+
+# Keep-alive session for Imgur API requests, to avoid a new TCP connection and
+# TLS handshake for every album.
+IMGUR_SESSION = requests.Session()
+IMGUR_SESSION.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32))
+
+# Regular expressions used to sanitize captions, compiled once and reused for
+# every caption. Matches are not case-sensitive:
+#   - Sub-strings enclosed in brackets ``[]()``.
+#   - Image resolutions such as "1920 x 1080".
+#   - Multiple whitespaces (replaced by a single space).
+#   - Usernames starting with ``@`` (replaced by ``<usr>`` token).
+_BRACKETS_RE = re.compile(r"[\[\(].*?[\]\)]", re.IGNORECASE)
+_RESOLUTION_RE = re.compile(r"\s*\d+\s*[x×\*\,]\s*\d+\s*", re.IGNORECASE)
+_WS_RE = re.compile(r"\s+")
+_USER_RE = re.compile(r"\@[_\d\w\.]+", re.IGNORECASE)
 
 
 class RedditInfoDownloader(object):
@@ -28,14 +53,21 @@ class RedditInfoDownloader(object):
 
     Args:
         credentials: OAuth credentials for Reddit and Imgur APIs.
+        num_workers: Number of threads to make concurrent Reddit API requests.
+            Each request gets info of up to 100 submissions.
     """
 
-    def __init__(self, credentials: Dict):
-        self.reddit = praw.Reddit(
-            client_id=credentials["reddit"]["client_id"],
-            client_secret=credentials["reddit"]["client_secret"],
-            user_agent=credentials["reddit"]["user_agent"],
-        )
+    def __init__(self, credentials: Dict, num_workers: int = 4):
+        self.reddit_credentials = {
+            "client_id": credentials["reddit"]["client_id"],
+            "client_secret": credentials["reddit"]["client_secret"],
+            "user_agent": credentials["reddit"]["user_agent"],
+        }
+        self.num_workers = num_workers
+
+        # PRAW is not thread-safe, every thread creates its own Reddit instance.
+        self._thread_local = threading.local()
+
         self.imgur_client_id = credentials["imgur"]["client_id"]
         self.imgur_client_secret = credentials["imgur"]["client_secret"]
 
@@ -51,7 +83,7 @@ class RedditInfoDownloader(object):
         # Gather annotations in this list.
         ANNOTATIONS: List[Dict[str, Any]] = []
 
-        for _info in tqdm(self.reddit.info(ids), "Downloading", total=len(ids)):
+        for _info in tqdm(self._iter_info(ids), "Downloading", total=len(ids)):
 
             # IMPORTANT: do not download any image posts that were deleted
             # from Reddit - either by the author, moderator, Reddit bots, etc.
@@ -97,6 +129,30 @@ class RedditInfoDownloader(object):
 
         return ANNOTATIONS
 
+    def _iter_info(self, ids: List[str]) -> Iterator[praw.models.Submission]:
+        r"""
+        Get info of submissions from Reddit API, in chunks of 100 IDs (maximum
+        allowed per request). Chunks are requested concurrently in background
+        threads, and submissions are yielded in the same order as ``ids``.
+        """
+        chunks = [ids[i : i + 100] for i in range(0, len(ids), 100)]
+
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            for infos in executor.map(self._info_worker, chunks):
+                yield from infos
+
+    def _info_worker(self, ids: List[str]) -> List[praw.models.Submission]:
+        r"""Helper method for parallelizing Reddit API requests."""
+
+        reddit = getattr(self._thread_local, "reddit", None)
+        if reddit is None:
+            reddit = praw.Reddit(**self.reddit_credentials)
+            self._thread_local.reddit = reddit
+
+        # Wait for our turn to make a request (after rate limit).
+        REDDIT_API_RATE_LIMITER.wait()
+        return list(reddit.info(ids))
+
     def _fix_image_url(self, image_url: str) -> str:
         r"""
         Get a static image URL from an Imgur URL. This method must be called in
@@ -137,34 +193,10 @@ class RedditInfoDownloader(object):
             # "album" and "gallery" are jointly referred as "album" henceforth.
             album_id = image_url.split("/")[-1]
 
-            # GET request to download static URL of image from Imgur link.
+            # Get static URL of image from Imgur API. Albums that appear again
+            # are not requested again (helps to stay within Imgur rate limits).
             try:
-                response = requests.get(
-                    f"https://api.imgur.com/3/album/{album_id}",
-                    headers={"Authorization": f"Client-ID {self.imgur_client_id}"},
-                )
-                content = json.loads(response.content)
-                direct_link = content["data"]["images"][0]["link"]
-
-                # Imgur allows 12500 client requests per day, and 500 user requests
-                # per hour. If client requests exceed limit, Imgur will block the
-                # IP for 1 month!
-                if int(response.headers["X-RateLimit-UserRemaining"]) <= 3:
-                    # Check the timestamp when Imgur will reset the user limit.
-                    reset_utc = int(response.headers["X-RateLimit-UserReset"])
-                    sleepdiff = reset_utc - int(time.time()) + 1
-
-                    cprint.yellow(
-                        "Exceeded Imgur UserLimit, sleeping till reset: "
-                        f"{sleepdiff} seconds."
-                    )
-                    time.sleep(sleepdiff)
-
-                if int(response.headers["X-RateLimit-ClientRemaining"]) <= 500:
-                    cprint.red(
-                        "!! Exceeded Imgur ClientLimit, pause script for 1 day !!"
-                    )
-                    sys.exit(0)
+                direct_link = _lookup_album(album_id, self.imgur_client_id)
             except Exception:
                 direct_link = "https://i.imgur.com/removed.png"
 
@@ -184,26 +216,68 @@ class RedditInfoDownloader(object):
             _Sanitized_ caption with the appropriate sub-strings removed.
         """
 
-        # Remove caption sub-strings matching these patterns. Match will not be
-        # case-sensitive. Specifically, remove things in brackets, and remove
-        # image resolutions.
-        regex_candidates = [r"[\[\(].*?[\]\)]", r"\s*\d+\s*[x×\*\,]\s*\d+\s*"]
-
-        # First remove all accents and widetexts from caption.
-        caption = ftfy.fix_text(caption, normalization="NFKD").lower()
-
-        # Remove all above regex candidates.
-        for regexc in regex_candidates:
-            caption = re.sub(regexc, "", caption, flags=re.IGNORECASE)
+        # First remove all accents and widetexts from caption. Most captions are
+        # plain ASCII text which ftfy leaves unchanged (unless it has HTML entities
+        # or control characters), skip ftfy for them as it is slow.
+        if caption.isascii() and caption.isprintable() and "&" not in caption:
+            caption = caption.lower()
+        else:
+            caption = ftfy.fix_text(caption, normalization="NFKD").lower()
 
-            # Remove multiple whitespaces, and leading or trailing whitespaces.
-            # We have to do it every time we remove a regex candidate as it may
-            # combine surrounding whitespaces.
-            caption = re.sub(r"\s+", " ", caption).strip()
+        # Remove things in brackets, and remove image resolutions. Then remove
+        # multiple whitespaces, and leading or trailing whitespaces. We have to
+        # do it every time we remove a pattern as it may combine surrounding
+        # whitespaces.
+        for pattern in (_BRACKETS_RE, _RESOLUTION_RE):
+            caption = pattern.sub("", caption)
+            caption = _WS_RE.sub(" ", caption).strip()
 
         # In this end, replace all usernames with `<usr>` token.
-        caption = re.sub(r"\@[_\d\w\.]+", "<usr>", caption, flags=re.IGNORECASE)
+        caption = _USER_RE.sub("<usr>", caption)
 
         # Remove all emojis and non-latin characters.
         caption = caption.encode("ascii", "ignore").decode("utf-8")
         return caption
+
+
+@lru_cache(maxsize=100000)
+def _lookup_album(album_id: str, client_id: str) -> str:
+    r"""
+    Get static URL of the first image in an Imgur album (or gallery) from Imgur
+    API. Successful lookups are cached, failed lookups raise an exception.
+
+    Args:
+        album_id: ID of the Imgur album, for example ``aBcDeF`` in the album URL
+            ``imgur.com/a/aBcDeF``.
+        client_id: Client ID for Imgur API.
+
+    Returns:
+        Imgur static URL starting as ``i.imgur.com/...``.
+    """
+
+    # GET request to download static URL of image from Imgur link.
+    response = IMGUR_SESSION.get(
+        f"https://api.imgur.com/3/album/{album_id}",
+        headers={"Authorization": f"Client-ID {client_id}"},
+        timeout=(3.05, 10),
+    )
+    content = json.loads(response.content)
+    direct_link = content["data"]["images"][0]["link"]
+
+    # Imgur allows 12500 client requests per day, and 500 user requests per
+    # hour. If client requests exceed limit, Imgur will block the IP for 1 month!
+    if int(response.headers["X-RateLimit-UserRemaining"]) <= 3:
+        # Check the timestamp when Imgur will reset the user limit.
+        reset_utc = int(response.headers["X-RateLimit-UserReset"])
+        sleepdiff = reset_utc - int(time.time()) + 1
+
+        cprint.yellow(
+            f"Exceeded Imgur UserLimit, sleeping till reset: {sleepdiff} seconds."
+        )
+        time.sleep(sleepdiff)
+
+    if int(response.headers["X-RateLimit-ClientRemaining"]) <= 500:
+        cprint.red("!! Exceeded Imgur ClientLimit, pause script for 1 day !!")
+        sys.exit(0)
+
+    return direct_link
@@ -3,16 +3,19 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-import json
 import os
+import re
 import sys
-import urllib
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List
 
 import click
 from tqdm import tqdm
 
 import redcaps._color_print as cprint
+from redcaps._io import dump_json, list_images, load_json
 
 # fmt: off
 # Two common options for all commands in this module.
@@ -45,7 +48,7 @@ def filter_words(annotations_filepath: str, images_dirpath: str):
     # Argument docstring is provided by click `help`.
 
     # Read annotations, keys: {"info", "annotations"}
-    ANNOTATIONS: Dict = json.load(open(annotations_filepath))
+    ANNOTATIONS: Dict = load_json(annotations_filepath)
 
     # Exit if this file has already been filtered, check via `info`.
     if "word_filter" in ANNOTATIONS["info"]:
@@ -53,23 +56,23 @@ def filter_words(annotations_filepath: str, images_dirpath: str):
         sys.exit(0)
 
     # Read the blocklist of 'bad' words from the Github repo.
-    blockwords_file = urllib.request.urlopen(
-        f"https://raw.githubusercontent.com/{WORDS_REPO}/master/en"
+    blockwords: List[str] = _get_blockwords()
+
+    # Match any of the words in a single pass over caption. Words must appear
+    # exactly, delimited by whitespaces (or start/end of caption). Try longer
+    # words first, so the longest matching phrase is reported.
+    blockwords = sorted(blockwords, key=len, reverse=True)
+    blockwords_regex = re.compile(
+        r"(?<![^ ])(?:" + "|".join(map(re.escape, blockwords)) + r")(?![^ ])"
     )
-    blockwords: List[str] = [
-        line.decode("utf-8").replace("\n", "") for line in blockwords_file
-    ]
     # Gather a list of image IDs to remove.
     ids_to_remove: List[str] = []
 
     for ann in tqdm(ANNOTATIONS["annotations"], desc="Filtering"):
-        for bad in blockwords:
-
-            # Pad the word and caption with whitespaces, and do exact match.
-            if f" {bad} " in f" {ann['caption']} ":
-                cprint.yellow(f"'{bad}' in {ann['image_id']}: {ann['caption']}.")
-                ids_to_remove.append(ann["image_id"])
-                break
+        match = blockwords_regex.search(ann["caption"])
+        if match is not None:
+            cprint.yellow(f"'{match.group(0)}' in {ann['image_id']}: {ann['caption']}.")
+            ids_to_remove.append(ann["image_id"])
 
     cprint.white(f"Annotations with any blocklist words: {len(ids_to_remove)}")
 
@@ -82,7 +85,7 @@ def filter_words(annotations_filepath: str, images_dirpath: str):
         "model": WORDS_REPO,
     }
     cprint.white(f"Saving updated annotations...")
-    json.dump(ANNOTATIONS, open(annotations_filepath, "w"))
+    dump_json(ANNOTATIONS, annotations_filepath)
     cprint.green(f"Saved updated annotations at {annotations_filepath}!")
 
 
@@ -101,12 +104,17 @@ def filter_words(annotations_filepath: str, images_dirpath: str):
     probabilities of "porn" and "hentai" must be higher than this to flag an
     image as NSFW.""",
 )
+@click.option(
+    "--mixed-precision", is_flag=True,
+    help="Run NSFW detector with FP16 mixed precision (only useful on GPU).",
+)
 # fmt: on
 def filter_nsfw(
     annotations_filepath: str,
     images_dirpath: str,
     model_path: str,
     confidence_threshold: float,
+    mixed_precision: bool,
 ):
     r"""
     Remove images (and their annotations) that are flagged as NSFW. The NSFW
@@ -119,27 +127,27 @@ def filter_nsfw(
     from redcaps.detectors.nsfw import NsfwDetector
 
     # Read annotations, keys: {"info", "annotations"}
-    ANNOTATIONS: Dict = json.load(open(annotations_filepath))
+    ANNOTATIONS: Dict = load_json(annotations_filepath)
 
     # Exit if this file has already been filtered.
     if "nsfw_filter" in ANNOTATIONS["info"]:
         cprint.red(f"{annotations_filepath} has already been NSFW-filtered.")
         sys.exit(0)
 
-    # Get a list of all image paths from the annotations.
-    image_paths: List[str] = [
-        os.path.join(images_dirpath, ann["subreddit"], f"{ann['image_id']}.jpg")
-        for ann in ANNOTATIONS["annotations"]
-    ]
-    image_paths = [_path for _path in image_paths if os.path.exists(_path)]
+    # Get a list of paths of all images (that exist) from the annotations.
+    image_paths = _get_image_paths(ANNOTATIONS["annotations"], images_dirpath)
 
-    predictions = NsfwDetector(model_path=model_path, verbose=True)(image_paths)
+    model = NsfwDetector(
+        model_path=model_path, verbose=True, mixed_precision=mixed_precision
+    )
+    predictions = model(image_paths)
 
     # Gather a list of image IDs to remove - where sum(porn, hentai) > 0.9
+    is_nsfw = predictions["porn"] + predictions["hentai"] > confidence_threshold
     ids_to_remove: List[str] = [
         os.path.basename(_path).replace(".jpg", "")
-        for _path, _pred in zip(image_paths, predictions)
-        if _pred["porn"] + _pred["hentai"] > confidence_threshold
+        for _path, _is_nsfw in zip(image_paths, is_nsfw)
+        if _is_nsfw
     ]
     cprint.white(f"Annotations (images) flagged as NSFW: {len(ids_to_remove)}")
 
@@ -154,7 +162,7 @@ def filter_nsfw(
         "confidence_threshold": confidence_threshold,
     }
     cprint.white(f"Saving updated annotations...")
-    json.dump(ANNOTATIONS, open(annotations_filepath, "w"))
+    dump_json(ANNOTATIONS, annotations_filepath)
     cprint.green(f"Saved updated annotations at {annotations_filepath}!")
 
 
@@ -166,9 +174,27 @@ def filter_nsfw(
     "-t", "--confidence-threshold", type=float, default=0.9,
     help="Minimum confidence value for face detections.",
 )
+@click.option(
+    "-d", "--device", default="cpu",
+    help="Device to run face detector on, for example 'cpu' or 'cuda'.",
+)
+@click.option(
+    "--jit", is_flag=True,
+    help="""Run a traced (TorchScript) face detector for faster inference. It is
+    traced in the first run and cached for later runs.""",
+)
+@click.option(
+    "-j", "--workers", type=int, default=4,
+    help="Number of worker processes to decode images for face detector.",
+)
 # fmt: on
 def filter_faces(
-    annotations_filepath: str, images_dirpath: str, confidence_threshold: float
+    annotations_filepath: str,
+    images_dirpath: str,
+    confidence_threshold: float,
+    device: str,
+    jit: bool,
+    workers: int,
 ):
     r"""
     Remove images (and their annotations) that contain any detected faces. Face
@@ -181,22 +207,20 @@ def filter_faces(
     from redcaps.detectors.faces import FaceDetector
 
     # Read annotations, keys: {"info", "annotations"}
-    ANNOTATIONS: Dict = json.load(open(annotations_filepath))
+    ANNOTATIONS: Dict = load_json(annotations_filepath)
 
     # Exit if this file has already been filtered.
     if "face_filter" in ANNOTATIONS["info"]:
         cprint.red(f"{annotations_filepath} has already been face-filtered.")
         sys.exit(0)
 
-    # Get a list of all image paths from the annotations.
-    image_paths: List[str] = [
-        os.path.join(images_dirpath, ann["subreddit"], f"{ann['image_id']}.jpg")
-        for ann in ANNOTATIONS["annotations"]
-    ]
-    image_paths = [_path for _path in image_paths if os.path.exists(_path)]
+    # Get a list of paths of all images (that exist) from the annotations.
+    image_paths = _get_image_paths(ANNOTATIONS["annotations"], images_dirpath)
 
-    model = FaceDetector(verbose=True)
-    predictions = model(image_paths, conf_threshold=confidence_threshold)
+    model = FaceDetector(verbose=True, device=device, jit=jit)
+    predictions = model(
+        image_paths, conf_threshold=confidence_threshold, num_workers=workers
+    )
 
     ids_to_remove: List[str] = [
         os.path.basename(_path).replace(".jpg", "")
@@ -216,10 +240,63 @@ def filter_faces(
         "confidence_threshold": confidence_threshold,
     }
     cprint.white(f"Saving updated annotations...")
-    json.dump(ANNOTATIONS, open(annotations_filepath, "w"))
+    dump_json(ANNOTATIONS, annotations_filepath)
     cprint.green(f"Saved updated annotations at {annotations_filepath}!")
 
 
+def _get_blockwords() -> List[str]:
+    r"""
+    Get the blocklist of 'bad' words from the Github repo. This list is cached
+    locally (in ``~/.cache/redcaps``) and downloaded again only if the cached
+    list is older than 30 days, or if it is missing. Words are lowercased to
+    match captions (which are lowercase).
+    """
+    cache_path = os.path.join(
+        os.path.expanduser("~/.cache/redcaps"), "blockwords_en.txt"
+    )
+
+    if (
+        not os.path.exists(cache_path)
+        or time.time() - os.path.getmtime(cache_path) > 30 * 86400
+    ):
+        try:
+            blockwords_file = urllib.request.urlopen(
+                f"https://raw.githubusercontent.com/{WORDS_REPO}/master/en"
+            )
+            blockwords_text = blockwords_file.read().decode("utf-8")
+
+            # Write to a temporary file first, so an interrupted write does not
+            # leave a partial list in cache.
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(f"{cache_path}.tmp", "w", encoding="utf-8") as f:
+                f.write(blockwords_text)
+            os.replace(f"{cache_path}.tmp", cache_path)
+
+        except Exception:
+            # Fall back to an older cached list (if any) when offline.
+            if not os.path.exists(cache_path):
+                raise
+            cprint.yellow(f"Could not download blocklist, using {cache_path}.")
+
+    with open(cache_path, encoding="utf-8") as f:
+        return [line.lower() for line in f.read().splitlines() if line]
+
+
+def _get_image_paths(annotations: List[Dict], images_dirpath: str) -> List[str]:
+    r"""
+    Given a list of annotations, get paths of their images that exist on disk,
+    in the same order as annotations.
+    """
+    existing_images = list_images(
+        images_dirpath, {ann["subreddit"] for ann in annotations}
+    )
+    return [
+        os.path.join(images_dirpath, ann["subreddit"], f"{ann['image_id']}.jpg")
+        for ann in annotations
+        if f"{ann['image_id']}.jpg" in existing_images[ann["subreddit"]]
+    ]
+
+
 def _remove_images_and_annotations(
     annotations: List[Dict], ids_to_remove: List[str], images_dirpath: str
 ):
@@ -228,15 +305,25 @@ def _remove_images_and_annotations(
     and delete images from disk.
     """
     annotations_map = {ann["image_id"]: ann for ann in annotations}
+    image_paths: List[str] = []
 
     for _id in ids_to_remove:
         ann = annotations_map.pop(_id)
+        image_paths.append(os.path.join(images_dirpath, ann["subreddit"], f"{_id}.jpg"))
 
-        # Remove image if it exists.
-        image_path = os.path.join(images_dirpath, ann["subreddit"], f"{_id}.jpg")
-        if os.path.exists(image_path):
-            os.unlink(image_path)
+    # Delete images in parallel threads, this is much faster on network file
+    # systems where every deletion has a high latency.
+    with ThreadPoolExecutor(max_workers=64) as executor:
+        list(executor.map(_remove_image, image_paths))
 
     # Sort annotations by timestamp in case they got messed up.
     annotations = sorted(list(annotations_map.values()), key=lambda k: k["created_utc"])
     return annotations
+
+
+def _remove_image(image_path: str):
+    r"""Remove an image from disk if it exists."""
+    try:
+        os.unlink(image_path)
+    except FileNotFoundError:
+        pass
@@ -4,16 +4,19 @@
 # LICENSE file in the root directory of this source tree.
 
 import glob
-import json
 import os
 import sys
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, List
+from typing import Any, Deque, Dict, Iterator, List, Tuple
 
 import click
+import orjson
 
 import redcaps
 import redcaps._color_print as cprint
+from redcaps._io import load_json
 
 
 @click.command()
@@ -53,18 +56,19 @@ def merge(annotation_filepaths: List[str], save_to: str, delete_old: bool):
         cprint.red("Nothing to merge: provided less than two file paths!")
         return
 
-    # Accumulate annotations in this list.
-    MERGED_ANNOTATIONS: List[Dict] = []
+    # Accumulate unique annotations by ID in this dict. Each file is merged as
+    # soon as it is read, so only a few files are fully held in memory at once.
+    MERGED_ANNOTATIONS: Dict[str, Dict] = {}
 
     # Gather ``start_date`` and ``end_date`` from each file.
     all_start_dates: List[datetime] = []
     all_end_dates: List[datetime] = []
 
-    for afp in sorted(ALL_ANNOTATION_FILEPATHS):
-        annotations = json.load(open(afp))
+    for afp, annotations in _prefetch_json(sorted(ALL_ANNOTATION_FILEPATHS)):
 
         # Add "annotations" from this file.
-        MERGED_ANNOTATIONS.extend(annotations["annotations"])
+        for ann in annotations["annotations"]:
+            MERGED_ANNOTATIONS[ann["image_id"]] = ann
 
         # --------------------------------------------------------------------
         # Handle info while merging.
@@ -103,28 +107,35 @@ def merge(annotation_filepaths: List[str], save_to: str, delete_old: bool):
 
         # --------------------------------------------------------------------
 
-    # Take uniques among annotations by ID.
-    MERGED_ANNOTATIONS = {ann["image_id"]: ann for ann in MERGED_ANNOTATIONS}
-    MERGED_ANNOTATIONS = list(MERGED_ANNOTATIONS.values())
+        # Free this file as soon as it is merged.
+        del annotations
 
     # Sort annotations by timestamp.
-    MERGED_ANNOTATIONS = sorted(MERGED_ANNOTATIONS, key=lambda k: k["created_utc"])
-
-    annotations_to_save = {
-        "info": {
-            "start_date": min(*all_start_dates).strftime("%Y-%m-%d"),
-            "end_date": max(*all_end_dates).strftime("%Y-%m-%d"),
-            "url": "https://redcaps.xyz",
-            "version": redcaps.__version__,
-        },
-        "annotations": MERGED_ANNOTATIONS,
+    annotations_to_save: List[Dict] = sorted(
+        MERGED_ANNOTATIONS.values(), key=lambda k: k["created_utc"]
+    )
+    info_to_save = {
+        "start_date": min(*all_start_dates).strftime("%Y-%m-%d"),
+        "end_date": max(*all_end_dates).strftime("%Y-%m-%d"),
+        "url": "https://redcaps.xyz",
+        "version": redcaps.__version__,
     }
     # Save the merged annotations file.
     cprint.green(f"Saving merged file at {save_to}.")
 
     cprint.white(f"Saving merged annotations at {save_to}...")
     os.makedirs(os.path.dirname(save_to) or os.curdir, exist_ok=True)
-    json.dump(annotations_to_save, open(save_to, "w"))
+
+    # Write annotations one by one, instead of serializing the whole merged
+    # file in memory at once. Output has same format as other annotation files.
+    with open(save_to, "wb") as f:
+        f.write(b'{"info":' + orjson.dumps(info_to_save) + b',"annotations":[')
+        for idx, ann in enumerate(annotations_to_save):
+            if idx > 0:
+                f.write(b",")
+            f.write(orjson.dumps(ann))
+        f.write(b"]}")
+
     cprint.green(f"Done!")
 
     # Optionally delete old files.
@@ -138,3 +149,34 @@ def merge(annotation_filepaths: List[str], save_to: str, delete_old: bool):
             if os.path.abspath(old_afp) != os.path.abspath(save_to):
                 os.unlink(old_afp)
                 cprint.red(f"Deleted {old_afp}!")
+
+
+def _prefetch_json(
+    filepaths: List[str], num_prefetch: int = 4
+) -> Iterator[Tuple[str, Any]]:
+    r"""
+    Read JSON files in background threads while the caller processes the files
+    read earlier, and yield ``(filepath, parsed object)`` in the same order as
+    ``filepaths``. At most ``num_prefetch`` files are read ahead of the caller.
+    """
+    with ThreadPoolExecutor(max_workers=num_prefetch) as executor:
+        futures = deque()
+
+        for filepath in filepaths:
+            futures.append((filepath, executor.submit(load_json, filepath)))
+
+            if len(futures) > num_prefetch:
+                yield _pop_result(futures)
+
+        while len(futures) > 0:
+            yield _pop_result(futures)
+
+
+def _pop_result(futures: Deque[Tuple[str, Future]]) -> Tuple[str, Any]:
+    r"""
+    Pop the oldest ``(filepath, future)`` pair and return its filepath and result.
+    No reference to the future (or result) is kept in :func:`_prefetch_json`
+    while the caller holds the result, so the caller can free it when done.
+    """
+    filepath, future = futures.popleft()
+    return filepath, future.result()
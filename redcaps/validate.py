@@ -3,7 +3,6 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-import json
 import sys
 from datetime import datetime, timedelta, timezone
 from typing import Dict
@@ -12,6 +11,7 @@ import click
 from tqdm import tqdm
 
 import redcaps._color_print as cprint
+from redcaps._io import load_json
 
 
 @click.command()
@@ -32,7 +32,7 @@ def validate(annotations_filepath: str):
 
     # Read annotations, keys: {"info", "annotations"}
     cprint.white(f"Validating {annotations_filepath}...")
-    ANNOTATIONS: Dict = json.load(open(annotations_filepath))
+    ANNOTATIONS: Dict = load_json(annotations_filepath)
 
     # Annotations file must not have any missing keys.
     for key in {"info", "annotations"}:
@@ -64,9 +64,11 @@ def validate(annotations_filepath: str):
         end_utc = end_utc + timedelta(hours=24, seconds=-1)
         end_utc = end_utc.replace(tzinfo=timezone.utc)
 
-        if "annotations" in ANNOTATIONS["annotations"]:
-            for ann in tqdm(ANNOTATIONS["annotations"], desc="Check timestamps"):
-                if not (start_utc <= ann["created_utc"] <= end_utc):
-                    cprint.yellow(f"Found ID {ann['id']} outside time limits!")
+        # Annotations have integer Unix timestamps, compare them as integers.
+        start_ts, end_ts = int(start_utc.timestamp()), int(end_utc.timestamp())
+
+        for ann in tqdm(ANNOTATIONS["annotations"], desc="Check timestamps"):
+            if not (start_ts <= ann["created_utc"] <= end_ts):
+                cprint.yellow(f"Found ID {ann['image_id']} outside time limits!")
 
     cprint.white("Done. If nothing was printed above then file is valid!")
@@ -8,10 +8,18 @@ named "input.json" with 2500 instances and Z = 1000 would make three TAR files:
     {output_dir}/{input}_00000002.tar : instance ID [2000 to 2499] from JSON
 """
 import argparse
+import io
 import json
-import tarfile
-import tempfile
+import mmap
+import os
+import struct
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from math import ceil
 from pathlib import Path
+from typing import Dict, Iterator, List, Set, Tuple
 
 # fmt: off
 parser = argparse.ArgumentParser(description=__doc__)
@@ -30,70 +38,425 @@ parser.add_argument(
     "--format", choices=["json", "txt"], default="json",
     help="Format of the caption files.",
 )
+parser.add_argument(
+    "-j", "--processes", type=int, default=4,
+    help="Number of processes to write TAR file shards in parallel.",
+)
+parser.add_argument(
+    "--mmap", action="store_true",
+    help="""Copy images into TAR files through memory maps instead of `sendfile`
+    (or reads). This may be faster on hosts with plenty of RAM.""",
+)
+parser.add_argument(
+    "--preallocate", action="store_true",
+    help="""Reserve disk space for every TAR file upfront to avoid fragmented
+    files. Only use on filesystems that support `fallocate` natively, others
+    (like NFSv3) emulate it by writing every block, which is very slow.""",
+)
+parser.add_argument(
+    "--stat-only", action="store_true",
+    help="""Only parse annotations and check which images exist, without making
+    TAR files. Useful to measure time spent on each step.""",
+)
 # fmt: on
 
+# Size of buffer (in bytes) to write TAR files. TAR files are written in small
+# pieces (512-byte headers), a large buffer turns them into few large writes.
+BUFFER_SIZE: int = 2 * 1024 * 1024
 
-def main(_A: argparse.Namespace):
+# Rough average size (in bytes) of an image and its annotation in a TAR file,
+# used to preallocate disk space for TAR file shards.
+AVERAGE_INSTANCE_SIZE: int = 250_000
 
-    ANNOTATIONS = json.loads(Path(_A.input).read_text())["annotations"]
+# Layout of a USTAR header block of TAR files: name, mode, uid, gid, size, mtime,
+# checksum, type, link name, magic, version, user name, group name, devmajor,
+# devminor, name prefix and padding (to a block of 512 bytes).
+TAR_HEADER = struct.Struct("100s8s8s8s12s12s8sc100s6s2s32s32s8s8s155s12x")
 
-    # Create output directory if it does not exist.
-    output_dir = Path(_A.output_dir)
-    output_dir.mkdir(parents=True, exist_ok=True)
-    output_prefix = str(output_dir / Path(_A.input).stem)
+# Copy images into TAR files with `sendfile` (entirely in the kernel, without
+# reading them in Python). Only Linux supports `sendfile` between regular files.
+USE_SENDFILE: bool = sys.platform.startswith("linux")
 
-    # Check whether image directory is nested:
-    IMAGE_DIR = Path(_A.image_dir)
-    IS_NESTED = next(IMAGE_DIR.iterdir()).is_dir()
+# Encoder for annotation JSON files, created once and re-used for every file.
+# Output is compact (no whitespaces) and non-ASCII characters are not escaped.
+encode_json = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False).encode
 
-    # 1. Keep track of the current index of TAR file shard and dataset index.
-    # 2. Count number of images (and their annotations) added to TAR files.
-    # 3. Count number of annotations skipped because their image was absent.
-    SHARD_INDEX, ADDED_ANNS, SKIPD_ANNS = f"{0:0>8d}", 0, 0
 
-    # Create TAR file handle for the initial shard.
-    tar_handle = tarfile.open(f"{output_prefix}_{SHARD_INDEX}.tar", "w")
+def open_tar(path: str, preallocate: int = 0) -> io.BufferedWriter:
+    """
+    Open a TAR file for writing through a large write buffer. Files are added
+    using :func:`write_tar_entry` and it must be closed using :func:`close_tar`.
+    Disk space of ``preallocate`` bytes is reserved upfront to avoid a fragmented
+    file. If the filesystem does not support `fallocate`, glibc emulates it by
+    writing every block of the file, so this is disabled by default.
+    """
+    buffered_file = open(path, "wb", buffering=BUFFER_SIZE)
+    if preallocate > 0 and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(buffered_file.fileno(), 0, preallocate)
+        except OSError:
+            pass
 
-    for ann in ANNOTATIONS:
-        if IS_NESTED:
-            image_path = IMAGE_DIR / ann["subreddit"] / f"{ann['image_id']}.jpg"
-        else:
-            image_path = IMAGE_DIR / f"{ann['image_id']}.jpg"
+    return buffered_file
+
+
+def tar_header(name: str, size: int, mtime: int = 0) -> bytearray:
+    """
+    Make the header of a regular file for a TAR file opened by :func:`open_tar`.
+    The USTAR header is packed directly, this is much faster than :mod:`tarfile`
+    for many small files. File name must be at most 100 bytes long (in UTF-8).
+    """
+    name_bytes = name.encode("utf-8")
+    if len(name_bytes) > 100:
+        raise ValueError(f"File name is too long for a TAR header: {name}")
+
+    # fmt: off
+    header = bytearray(TAR_HEADER.pack(
+        name_bytes, b"0000644\0", b"0000000\0", b"0000000\0",
+        b"%011o\0" % size, b"%011o\0" % mtime, b" " * 8, b"0", b"",
+        b"ustar\0", b"00", b"", b"", b"0000000\0", b"0000000\0", b"",
+    ))
+    # fmt: on
+
+    # Checksum is the sum of all header bytes, with checksum field as spaces.
+    header[148:155] = b"%06o\0" % sum(header)
+    return header
+
+
+def write_tar_entry(
+    buffered_file: io.BufferedWriter, name: str, data: bytes, mtime: int = 0
+):
+    """
+    Add a regular file with given contents to a TAR file. Header, contents and
+    padding are joined in a single (buffered) write.
+    """
+    header = tar_header(name, len(data), mtime)
+    buffered_file.write(header + data + bytes(-len(data) % 512))
+
+
+def write_tar_image(
+    buffered_file: io.BufferedWriter,
+    name: str,
+    image_fd: int,
+    image_stat: os.stat_result,
+    use_mmap: bool = False,
+):
+    """
+    Add an image file to a TAR file, copying its contents from a file descriptor
+    opened by :func:`prefetch_images` (through a memory map if ``use_mmap`` is
+    True). The descriptor is not closed.
+    """
+    size = image_stat.st_size
+    buffered_file.write(tar_header(name, size, int(image_stat.st_mtime)))
+
+    if use_mmap and size > 0:
+        with mmap.mmap(image_fd, size, access=mmap.ACCESS_READ) as image_map:
+            if hasattr(image_map, "madvise"):
+                image_map.madvise(mmap.MADV_SEQUENTIAL)
+            buffered_file.write(image_map)
+    elif USE_SENDFILE:
+        # Write out buffered data first, image is copied directly after it. This
+        # is the only flush per instance: padding of the previous image, its
+        # caption file and header of this image are all written together.
+        buffered_file.flush()
+        offset = 0
+        while offset < size:
+            sent = os.sendfile(buffered_file.fileno(), image_fd, offset, size - offset)
+            if sent == 0:
+                raise OSError(f"Image file was truncated while copying: {name}")
+            offset += sent
+    else:
+        with open(image_fd, "rb", closefd=False) as image_file:
+            buffered_file.write(image_file.read(size))
+
+    buffered_file.write(bytes(-size % 512))
+
+
+def close_tar(buffered_file: io.BufferedWriter):
+    """
+    Close a TAR file opened by :func:`open_tar`: write end-of-archive marker (two
+    zero blocks, padded to a record of 10240 bytes like :mod:`tarfile`), flush
+    all buffered writes, and trim any unused preallocated space. Its contents
+    are not read again, so they are dropped from the page cache. Returns the
+    size of TAR file (in bytes).
+    """
+    end_size = 1024 + (-(buffered_file.tell() + 1024) % 10240)
+    buffered_file.write(bytes(end_size))
+    buffered_file.flush()
+
+    tar_size = buffered_file.tell()
+    os.ftruncate(buffered_file.fileno(), tar_size)
+
+    # Dirty pages (not yet written to disk) are not dropped from page cache, so
+    # wait for the writes to finish first. This runs in a background thread.
+    if hasattr(os, "fdatasync"):
+        os.fdatasync(buffered_file.fileno())
+    fadvise(buffered_file.fileno(), "POSIX_FADV_DONTNEED")
+    buffered_file.close()
+    print(f"Saved shard: {buffered_file.name}")
+    return tar_size
+
+
+def load_annotations(path: str) -> List[Dict]:
+    """
+    Read annotations from a RedCaps annotation JSON file, keeping only the keys
+    that are added in TAR files. The rest of parsed JSON (and raw file contents)
+    are freed immediately, this considerably reduces memory usage.
+    """
+    with open(path, "rb") as f:
+        ANNOTATIONS = json.loads(f.read())["annotations"]
+
+    return [
+        {key: ann[key] for key in ("image_id", "subreddit", "caption")}
+        for ann in ANNOTATIONS
+    ]
+
+
+def fadvise(fd: int, advice: str):
+    """
+    Declare an access pattern for file contents (``advice`` is the name of a
+    ``POSIX_FADV_*`` constant of :mod:`os`). No-op where unsupported.
+    """
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+
+
+def open_image(image_path: str) -> int:
+    """
+    Open an image file for reading and return its file descriptor. Access time
+    of image is not updated, if allowed by the OS (Linux only).
+    """
+    try:
+        return os.open(image_path, os.O_RDONLY | getattr(os, "O_NOATIME", 0))
+    except PermissionError:
+        # Only file owner (or root) can skip updating access time.
+        return os.open(image_path, os.O_RDONLY)
+
+
+def prefetch_image(image_path: str) -> Tuple[int, os.stat_result]:
+    """
+    Open an image file, return its file descriptor and metadata (from ``fstat``).
+    The OS is asked to start reading its contents in background (readahead).
+    """
+    image_fd = open_image(image_path)
+    fadvise(image_fd, "POSIX_FADV_SEQUENTIAL")
+    fadvise(image_fd, "POSIX_FADV_WILLNEED")
+    return image_fd, os.fstat(image_fd)
 
-        # Skip current annotation if its image does not exist.
-        if not image_path.exists():
-            SKIPD_ANNS += 1
-            continue
 
-        # Dump annotation JSON to a temporary file to add in TAR.
-        with tempfile.NamedTemporaryFile("w+") as tmpfile:
-            if _A.format == 'json':
-                add_in_tar = {"subreddit": ann["subreddit"], "caption": ann["caption"]}
-                data = json.dumps(add_in_tar)
-            else:
-                data = ann["caption"]
+def close_image(image_fd: int):
+    """
+    Close an image file opened by :func:`prefetch_image`. Every image is read
+    exactly once, so it is not kept in the page cache.
+    """
+    fadvise(image_fd, "POSIX_FADV_DONTNEED")
+    os.close(image_fd)
 
-            tmpfile.write(data)
-            tmpfile.seek(0)
 
-            # Add image (JPG) and annotation (JSON) in TAR file.
-            tar_handle.add(image_path, arcname=f"{ann['image_id']}.jpg")
-            tar_handle.add(tmpfile.name, arcname=f"{ann['image_id']}.{_A.format}")
+def prefetch_images(
+    image_paths: List[str], num_threads: int = 4, lookahead: int = 32
+) -> Iterator[Tuple[int, os.stat_result]]:
+    """
+    Open images (and start reading them) in background threads, and yield their
+    file descriptors in the same order as ``image_paths``. Up to ``lookahead``
+    images are opened ahead of the caller, so reading images overlaps with
+    writing them in TAR files. Caller must close them using :func:`close_image`.
+    """
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = deque()
 
-        ADDED_ANNS += 1
+        for image_path in image_paths:
+            futures.append(executor.submit(prefetch_image, image_path))
+
+            if len(futures) > lookahead:
+                yield futures.popleft().result()
+
+        while len(futures) > 0:
+            yield futures.popleft().result()
+
+
+def batch_exists(paths: List[str], num_threads: int = 64) -> List[bool]:
+    """
+    Check whether files exist at all the given paths. Instead of one ``stat``
+    call per path, list every parent directory once (usually one per subreddit)
+    and look up file names in those listings. Directories are listed in many
+    parallel threads.
+    """
+    dirnames = sorted({os.path.dirname(path) for path in paths})
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        listings = dict(zip(dirnames, executor.map(_list_files, dirnames)))
+
+    return [os.path.basename(path) in listings[os.path.dirname(path)] for path in paths]
+
+
+def _list_files(dirname: str) -> Set[str]:
+    """List names of files in a directory, this is empty if directory is absent."""
+    try:
+        with os.scandir(dirname or ".") as entries:
+            return {entry.name for entry in entries if entry.is_file()}
+    except (FileNotFoundError, NotADirectoryError):
+        return set()
+
+
+def write_shards(
+    output_prefix: str,
+    shard_index: int,
+    annotations: List[Dict],
+    image_paths: List[str],
+    caption_format: str,
+    shard_size: int,
+    use_mmap: bool = False,
+    preallocate: bool = False,
+) -> int:
+    """
+    Write annotations (and their images) in TAR file shards of ``shard_size``
+    instances each, starting from the given shard index. All images must exist.
+    Disk space is reserved for every shard upfront if ``preallocate`` is True.
+    Returns the total size of written TAR files (in bytes).
+    """
+
+    # 1. Keep track of the current index of TAR file shard.
+    # 2. Count number of images (and their annotations) that can still be added
+    #    to the current shard (a countdown instead of a modulo per instance).
+    SHARD_INDEX, REMAINING = shard_index, shard_size
+
+    # Create TAR file handle for the initial shard.
+    preallocate_size = shard_size * AVERAGE_INSTANCE_SIZE if preallocate else 0
+    tar_file = open_tar(f"{output_prefix}_{SHARD_INDEX:0>8d}.tar", preallocate_size)
+
+    # Finished shards are closed (flushed) in a background thread, so writing
+    # the next shard need not wait for it.
+    close_executor = ThreadPoolExecutor(max_workers=2)
+    closed_tars = []
+
+    for ann, (image_fd, image_stat) in zip(annotations, prefetch_images(image_paths)):
 
         # Close TAR file shard to finalize current shard once it is full
         # with `Z` instances. Then create a new shard.
-        if ADDED_ANNS % _A.shard_size == 0 and ADDED_ANNS > 0:
-            tar_handle.close()
-            print(f"Saved shard: {output_prefix}_{SHARD_INDEX}.tar")
+        if REMAINING == 0:
+            closed_tars.append(close_executor.submit(close_tar, tar_file))
+            REMAINING = shard_size
+
+            SHARD_INDEX += 1
+            tar_file = open_tar(
+                f"{output_prefix}_{SHARD_INDEX:0>8d}.tar", preallocate_size
+            )
 
-            SHARD_INDEX = f"{int(SHARD_INDEX) + 1:0>8d}"
-            tar_handle = tarfile.open(f"{output_prefix}_{SHARD_INDEX}.tar", "w")
+        # Serialize annotation to add in TAR, directly from memory.
+        if caption_format == "json":
+            add_in_tar = {"subreddit": ann["subreddit"], "caption": ann["caption"]}
+            data = encode_json(add_in_tar).encode("utf-8")
+        else:
+            data = ann["caption"].encode("utf-8")
+
+        # Add image (JPG) and annotation (JSON) in TAR file.
+        image_id = ann["image_id"]
+        write_tar_image(tar_file, f"{image_id}.jpg", image_fd, image_stat, use_mmap)
+        close_image(image_fd)
+        write_tar_entry(tar_file, f"{image_id}.{caption_format}", data)
+
+        REMAINING -= 1
 
     # Close the last TAR file handle to properly save it.
-    tar_handle.close()
-    print(f"Saved shard: {output_prefix}_{SHARD_INDEX}.tar\n")
+    closed_tars.append(close_executor.submit(close_tar, tar_file))
+    close_executor.shutdown(wait=True)
+    return sum(future.result() for future in closed_tars)
+
+
+def main(_A: argparse.Namespace):
+
+    # Measure wall-clock time of each step: parsing annotations, checking which
+    # images exist, and writing TAR files.
+    start_time = time.perf_counter()
+    ANNOTATIONS = load_annotations(_A.input)
+    parse_time = time.perf_counter() - start_time
+
+    # Check whether image directory is nested:
+    IMAGE_DIR = Path(_A.image_dir)
+    IS_NESTED = next(IMAGE_DIR.iterdir()).is_dir()
+
+    # Get paths of images of all annotations, and check which ones exist. Use
+    # plain strings for paths, `Path` objects are slow to create in bulk.
+    image_dir = str(IMAGE_DIR)
+    if IS_NESTED:
+        IMAGE_PATHS = [
+            f"{image_dir}/{ann['subreddit']}/{ann['image_id']}.jpg"
+            for ann in ANNOTATIONS
+        ]
+    else:
+        IMAGE_PATHS = [f"{image_dir}/{ann['image_id']}.jpg" for ann in ANNOTATIONS]
+
+    start_time = time.perf_counter()
+    IMAGE_EXISTS = batch_exists(IMAGE_PATHS)
+    check_time = time.perf_counter() - start_time
+
+    # Skip annotations whose images do not exist.
+    SKIPD_ANNS = IMAGE_EXISTS.count(False)
+    ANNOTATIONS = [ann for ann, e in zip(ANNOTATIONS, IMAGE_EXISTS) if e]
+    IMAGE_PATHS = [path for path, e in zip(IMAGE_PATHS, IMAGE_EXISTS) if e]
+
+    print(f"Parsed {len(IMAGE_EXISTS)} annotations in {parse_time:.2f} seconds.")
+    print(
+        f"Checked {len(IMAGE_EXISTS)} images in {check_time:.2f} seconds "
+        f"({len(IMAGE_EXISTS) / max(check_time, 1e-9):.0f} images/sec), "
+        f"{SKIPD_ANNS} are missing."
+    )
+    if _A.stat_only:
+        return
+
+    # Create output directory if it does not exist.
+    output_dir = Path(_A.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    output_prefix = str(output_dir / Path(_A.input).stem)
+
+    # Group instances by subreddit within every shard, so images are read from
+    # one (nested) directory at a time. Shards still have the same instances.
+    if IS_NESTED:
+        Z = _A.shard_size
+        ORDER = [
+            index
+            for start in range(0, len(ANNOTATIONS), Z)
+            for index in sorted(
+                range(start, min(start + Z, len(ANNOTATIONS))),
+                key=lambda index: ANNOTATIONS[index]["subreddit"],
+            )
+        ]
+        ANNOTATIONS = [ANNOTATIONS[index] for index in ORDER]
+        IMAGE_PATHS = [IMAGE_PATHS[index] for index in ORDER]
+
+    # Shards are independent of each other, write them in parallel processes.
+    # Every process writes a contiguous range of shards, so shards have same
+    # instances as if they were written one after another.
+    num_shards = max(ceil(len(ANNOTATIONS) / _A.shard_size), 1)
+    shards_per_process = ceil(num_shards / _A.processes)
+    group_size = shards_per_process * _A.shard_size
+
+    start_time = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=_A.processes) as executor:
+        futures = [
+            executor.submit(
+                write_shards,
+                output_prefix,
+                shard_index=start // _A.shard_size,
+                annotations=ANNOTATIONS[start : start + group_size],
+                image_paths=IMAGE_PATHS[start : start + group_size],
+                caption_format=_A.format,
+                shard_size=_A.shard_size,
+                use_mmap=_A.mmap,
+                preallocate=_A.preallocate,
+            )
+            for start in range(0, max(len(ANNOTATIONS), 1), group_size)
+        ]
+        written_bytes = sum(future.result() for future in futures)
+
+    write_time = max(time.perf_counter() - start_time, 1e-9)
+
+    print(
+        f"\nWrote {len(ANNOTATIONS)} instances ({written_bytes} bytes) in "
+        f"{write_time:.2f} seconds ({len(ANNOTATIONS) / write_time:.0f} "
+        f"annotations/sec, {written_bytes / write_time / 2**20:.1f} MiB/sec)."
+    )
     print(f"Skipped {SKIPD_ANNS} annotations due to missing images.")
 
 
@@ -23,7 +23,8 @@ setup(
     name="redcaps",
     version=get_version("redcaps/__init__.py"),
     author="Karan Desai",
-    python_requires=">=3.6",
+    python_requires=">=3.7",
+    extras_require={"fast": ["pillow-simd>=9.0.0.post1"]},
     entry_points={"console_scripts": ["redcaps=redcaps.main:main"]},
     license="MIT",
     zip_safe=True,
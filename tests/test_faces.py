@@ -0,0 +1,73 @@
+# Copyright (c) Karan Desai (https://kdexd.xyz), The University of Michigan.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from redcaps.detectors.faces import FaceDetector
+
+
+class _TinyRetinaFace(torch.nn.Module):
+    r"""
+    Randomly initialized stand-in for RetinaFace with the same output layout:
+    two anchors per pixel of feature maps with strides (8, 16, 32). Convolution
+    biases make outputs over any padding non-zero, like the real model.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.pools = torch.nn.ModuleList(
+            [torch.nn.AvgPool2d(step, ceil_mode=True) for step in (8, 16, 32)]
+        )
+        self.heads = torch.nn.ModuleList(
+            [torch.nn.Conv2d(3, 12, 3, padding=1) for _ in range(3)]
+        )
+
+    def forward(self, images: torch.Tensor):
+        outputs = []
+        for pool, head in zip(self.pools, self.heads):
+            level = head(pool(images / 128.0)).permute(0, 2, 3, 1)
+            outputs.append(level.reshape(len(images), -1, 6))
+
+        outputs = torch.cat(outputs, dim=1)
+        return outputs[..., :4], outputs[..., 4:].softmax(dim=-1), None
+
+
+@pytest.fixture
+def detector(monkeypatch):
+    torch.manual_seed(0)
+    monkeypatch.setattr(torch.hub, "load", lambda *args, **kwargs: _TinyRetinaFace())
+    return FaceDetector(verbose=False)
+
+
+def test_detections_do_not_depend_on_batch(detector, tmp_path):
+    # Images of different sizes, some of them shared by many images.
+    sizes = [(96, 64), (80, 120), (96, 64), (50, 70), (96, 64), (80, 120)]
+    rng = np.random.default_rng(0)
+
+    image_paths = []
+    for idx, (w, h) in enumerate(sizes):
+        pixels = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+        image_paths.append(str(tmp_path / f"{idx}.jpg"))
+        Image.fromarray(pixels).save(image_paths[-1])
+
+    single = detector(image_paths, conf_threshold=0.5, batch_size=1, num_workers=0)
+    batched = detector(image_paths, conf_threshold=0.5, batch_size=4, num_workers=0)
+
+    assert sum(len(pred["boxes"]) for pred in single) > 0
+    for pred_single, pred_batched in zip(single, batched):
+        assert len(pred_single["boxes"]) == len(pred_batched["boxes"])
+        np.testing.assert_allclose(
+            pred_single["boxes"], pred_batched["boxes"], atol=1e-4
+        )
+        np.testing.assert_allclose(
+            pred_single["scores"], pred_batched["scores"], atol=1e-5
+        )
+
+        # All boxes are well-formed (they are not clipped to image boundaries).
+        for x1, y1, x2, y2 in pred_batched["boxes"]:
+            assert x1 <= x2 and y1 <= y2